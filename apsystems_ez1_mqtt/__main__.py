@@ -1,6 +1,8 @@
 """This is the entry point of the script and it runs the main function in an asynchronous manner."""
 import asyncio
-from apsystems_ez1_mqtt.main import main
+from apsystems_ez1_mqtt.main import main, use_uvloop
 
+# Use uvloop as event loop, if available.
+use_uvloop()
 # Run the main coroutine.
 asyncio.run(main())
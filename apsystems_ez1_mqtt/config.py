@@ -4,50 +4,124 @@
 # pylint: disable=too-many-instance-attributes, too-few-public-methods
 
 """Application config classes, can be set by file or env variable"""
+import copy
 import os
-import yaml
+from collections import OrderedDict
+from dataclasses import dataclass, field
 
-from str2bool import str2bool_exc
+# accepted string values of boolean config keys
+_TRUE = frozenset({"yes", "true", "t", "y", "1", "on"})
+_FALSE = frozenset({"no", "false", "f", "n", "0", "off"})
 
+# supported MQTT protocol versions
+_MQTT_PROTOCOLS = ("3.1.1", "5")
+
+# default time zone of the ECU, if not configured
+_TZ = os.environ.get("TZ")
+
+# parsed YAML config files (LRU), key is the file path, value is (mtime, size, config dict)
+_YAML_CACHE_SIZE = 100
+_yaml_cache: OrderedDict[str, tuple[int, int, dict]] = OrderedDict()
+
+
+def _str2bool(value) -> bool:
+    """Convert a config value (bool or string like "True", "f", "1") to bool"""
+    value = str(value).strip().lower()
+    if value in _TRUE:
+        return True
+    if value in _FALSE:
+        return False
+    raise ValueError(f"Invalid boolean value '{value}'")
+
+
+def _mqtt_protocol(value) -> str:
+    """Check a MQTT protocol version config value ("3.1.1" or "5")"""
+    value = str(value).strip()
+    if value not in _MQTT_PROTOCOLS:
+        raise ValueError(f"Invalid MQTT protocol version '{value}', expected one of {', '.join(_MQTT_PROTOCOLS)}")
+    return value
+
+
+@dataclass(slots=True)
 class MQTTConfig:
     """MQTT config"""
 
-    def __init__(self, cfg):
-        self.broker_addr: str = cfg.get("MQTT_BROKER_HOST", "127.0.0.1")
-        self.broker_port: int = int(cfg.get("MQTT_BROKER_PORT", 1883))
-        self.broker_user: str = cfg.get("MQTT_BROKER_USER", "")
-        self.broker_passwd: str = cfg.get("MQTT_BROKER_PASSWD", "")
-        self.client_id: str = cfg.get("MQTT_CLIENT_ID", "")
-        self.topic_prefix: str = cfg.get("MQTT_TOPIC_PREFIX", "")
-        self.secured_connection = str2bool_exc(str(
-            cfg.get("MQTT_BROKER_SECURED_CONNECTION", "f")))
-        if self.secured_connection:
-            self.cacerts_path = cfg.get("MQTT_BROKER_CACERTS_PATH", None)
-
-        self.homa_enabled = str2bool_exc(str(cfg.get("HOMA_ENABLED", "f")))
-        self.homa_systemid: str = cfg.get("HOMA_SYSTEMID", "")
-        self.homa_room: str = cfg.get("HOMA_ROOM", "Sensors")
-        self.homa_name: str = cfg.get("HOMA_NAME", "Solar PV")
-
-        self.hass_enabled = str2bool_exc(str(cfg.get("HASS_ENABLED", "f")))
-        self.hass_device_id: str = cfg.get("HASS_DEVICE_ID", "")
-        self.hass_device_name: str = cfg.get("HASS_DEVICE_NAME", "Solar PV")
-        self.hass_name_prefix: str = cfg.get("HASS_NAME_PREFIX", "")
-        self.hass_area: str = cfg.get("HASS_AREA", "Energie")
+    broker_addr: str = "127.0.0.1"
+    broker_port: int = 1883
+    broker_user: str = ""
+    broker_passwd: str = field(default="", repr=False)
+    client_id: str = ""
+    topic_prefix: str = ""
+    secured_connection: bool = False
+    cacerts_path: str | None = None
+    protocol: str = "5"
+    max_inflight: int = 128
+    max_queued: int = 256
 
+    homa_enabled: bool = False
+    homa_systemid: str = ""
+    homa_room: str = "Sensors"
+    homa_name: str = "Solar PV"
 
+    hass_enabled: bool = False
+    hass_device_id: str = ""
+    hass_device_name: str = "Solar PV"
+    hass_name_prefix: str = ""
+    hass_area: str = "Energie"
+
+    @classmethod
+    def from_cfg(cls, cfg):
+        """Create MQTT config from config dict (YAML file or env variables)"""
+        secured_connection = _str2bool(cfg.get("MQTT_BROKER_SECURED_CONNECTION", "f"))
+        return cls(
+            broker_addr=cfg.get("MQTT_BROKER_HOST", "127.0.0.1"),
+            broker_port=int(cfg.get("MQTT_BROKER_PORT", 1883)),
+            broker_user=cfg.get("MQTT_BROKER_USER", ""),
+            broker_passwd=cfg.get("MQTT_BROKER_PASSWD", ""),
+            client_id=cfg.get("MQTT_CLIENT_ID", ""),
+            topic_prefix=cfg.get("MQTT_TOPIC_PREFIX", ""),
+            secured_connection=secured_connection,
+            cacerts_path=(cfg.get("MQTT_BROKER_CACERTS_PATH") or None) if secured_connection else None,
+            protocol=_mqtt_protocol(cfg.get("MQTT_BROKER_PROTOCOL", "5")),
+            max_inflight=int(cfg.get("MQTT_MAX_INFLIGHT", 128)),
+            max_queued=int(cfg.get("MQTT_MAX_QUEUED", 256)),
+
+            homa_enabled=_str2bool(cfg.get("HOMA_ENABLED", "f")),
+            homa_systemid=cfg.get("HOMA_SYSTEMID", ""),
+            homa_room=cfg.get("HOMA_ROOM", "Sensors"),
+            homa_name=cfg.get("HOMA_NAME", "Solar PV"),
+
+            hass_enabled=_str2bool(cfg.get("HASS_ENABLED", "f")),
+            hass_device_id=cfg.get("HASS_DEVICE_ID", ""),
+            hass_device_name=cfg.get("HASS_DEVICE_NAME", "Solar PV"),
+            hass_name_prefix=cfg.get("HASS_NAME_PREFIX", ""),
+            hass_area=cfg.get("HASS_AREA", "Energie"))
+
+
+@dataclass(slots=True)
 class ECUConfig:
     """ECU config"""
 
-    def __init__(self, cfg):
-        self.ipaddr = cfg.get("APS_ECU_IP", "")
-        self.port = int(cfg.get("APS_ECU_PORT", 8050))
-        self.update_interval = int(cfg.get("APS_ECU_UPDATE_INTERVAL", 15))
-        self.timezone = cfg.get("APS_ECU_TIMEZONE", os.getenv("TZ", None))
-        self.stop_at_night = str2bool_exc(str(cfg.get("APS_ECU_STOP_AT_NIGHT", "f")))
-        if self.stop_at_night:
-            self.ecu_position_latitude = float(cfg.get("APS_ECU_POSITION_LAT", 52.5162))
-            self.ecu_position_longitude = float(cfg.get("APS_ECU_POSITION_LNG", 13.3777))
+    ipaddr: str = ""
+    port: int = 8050
+    update_interval: int = 15
+    timezone: str | None = None
+    stop_at_night: bool = False
+    ecu_position_latitude: float | None = None
+    ecu_position_longitude: float | None = None
+
+    @classmethod
+    def from_cfg(cls, cfg):
+        """Create ECU config from config dict (YAML file or env variables)"""
+        stop_at_night = _str2bool(cfg.get("APS_ECU_STOP_AT_NIGHT", "f"))
+        return cls(
+            ipaddr=cfg.get("APS_ECU_IP", ""),
+            port=int(cfg.get("APS_ECU_PORT", 8050)),
+            update_interval=int(cfg.get("APS_ECU_UPDATE_INTERVAL", 15)),
+            timezone=cfg.get("APS_ECU_TIMEZONE", _TZ),
+            stop_at_night=stop_at_night,
+            ecu_position_latitude=float(cfg.get("APS_ECU_POSITION_LAT", 52.5162)) if stop_at_night else None,
+            ecu_position_longitude=float(cfg.get("APS_ECU_POSITION_LNG", 13.3777)) if stop_at_night else None)
 
 
 class Config:
@@ -59,13 +133,31 @@ class Config:
         elif os.getenv("CONFIG_FILE") is not None:
             self.__load_yaml_config_file(os.getenv("CONFIG_FILE"))
         else:
-            cfg = os.environ
-            self.mqtt_config = MQTTConfig(cfg)
-            self.ecu_config = ECUConfig(cfg)
+            # plain dict lookups are cheaper than the os.environ mapping
+            cfg = dict(os.environ)
+            self.mqtt_config = MQTTConfig.from_cfg(cfg)
+            self.ecu_config = ECUConfig.from_cfg(cfg)
 
 
     def __load_yaml_config_file(self, config_path):
-        with open(config_path, "r", encoding="UTF-8") as yml_cfg:
-            cfg = yaml.safe_load(yml_cfg)
-            self.mqtt_config = MQTTConfig(cfg["mqtt"])
-            self.ecu_config = ECUConfig(cfg["ecu"])
+        st = os.stat(config_path)
+        entry = _yaml_cache.get(config_path)
+        if entry is not None and entry[:2] == (st.st_mtime_ns, st.st_size):
+            _yaml_cache.move_to_end(config_path)
+        else:
+            # import yaml only if needed, config may be given by env variables
+            # pylint: disable=import-outside-toplevel
+            from yaml import load as yaml_load
+            try:
+                from yaml import CSafeLoader as YamlLoader
+            except ImportError:
+                from yaml import SafeLoader as YamlLoader
+            with open(config_path, "r", encoding="UTF-8") as yml_cfg:
+                entry = (st.st_mtime_ns, st.st_size, yaml_load(yml_cfg, Loader=YamlLoader))
+            _yaml_cache[config_path] = entry
+            if len(_yaml_cache) > _YAML_CACHE_SIZE:
+                _yaml_cache.popitem(last=False)
+        # config classes may be changed later on, so never hand out the cached dict
+        cfg = copy.deepcopy(entry[2])
+        self.mqtt_config = MQTTConfig.from_cfg(cfg["mqtt"])
+        self.ecu_config = ECUConfig.from_cfg(cfg["ecu"])
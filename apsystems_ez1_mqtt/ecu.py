@@ -4,8 +4,10 @@
 """Handle APsystemsEZ1M ECU requests"""
 import logging
 
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, tzinfo
+from zoneinfo import ZoneInfo
 
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
 from APsystemsEZ1 import APsystemsEZ1M
 from astral import LocationInfo
 from astral.sun import daylight
@@ -16,7 +18,8 @@ _LOGGER = logging.getLogger(__name__)
 
 class ECU(APsystemsEZ1M):
     """
-    Extend class APsystemsEZ1M by night information and boolean OnOff power status
+    Extend class APsystemsEZ1M by night information and a kept alive HTTP session,
+    the boolean OnOff power status is provided by APsystemsEZ1M.get_device_power_status()
     """
 
     def __init__(self, ecu_config: ECUConfig, timeout: int = None):
@@ -25,33 +28,65 @@ class ECU(APsystemsEZ1M):
             timeout = 10 if ecu_config.update_interval > 10 else ecu_config.update_interval
         if timeout <= min_timeout:
             raise ValueError(f"timeout {timeout} too low, must be > {min_timeout}")
-        super().__init__(ecu_config.ipaddr, ecu_config.port, timeout, enable_debounce=True)
+        # keep one HTTP connection to the inverter alive instead of reconnecting on every request
+        session = ClientSession(connector=TCPConnector(limit=1), timeout=ClientTimeout(total=timeout))
+        super().__init__(ecu_config.ipaddr, ecu_config.port, timeout, session=session, enable_debounce=True)
         self.stop_at_night = ecu_config.stop_at_night
+        # night start and end only change once a day, cache them by date
+        self._night_cache: tuple[date, tuple[datetime, datetime]] | None = None
+        self._wake_epoch: float | None = None
+        self._wake_epoch_date: date | None = None
+        # time zone of the ECU, local time zone if not configured
+        self.tz: tzinfo | None = None
         if self.stop_at_night:
             self.city = LocationInfo("", "",
                                      ecu_config.timezone,
                                      ecu_config.ecu_position_latitude,
                                      ecu_config.ecu_position_longitude)
+            self.tz = self.city.tzinfo
+        elif ecu_config.timezone:
+            self.tz = ZoneInfo(ecu_config.timezone)
 
 
-    def night(self):
-        """Get start and end time of night depending on location and time zone"""
-        night_end, night_start = daylight(self.city.observer, tzinfo=self.city.tzinfo)
+    async def close(self):
+        """Close the HTTP session to the inverter"""
+        await self.session.close()
+
+
+    def night(self, today: date | None = None):
+        """Get start and end time of night depending on location and time zone, for today if not given"""
+        if today is None:
+            today = datetime.now(self.tz).date()
+        if self._night_cache and self._night_cache[0] == today:
+            return self._night_cache[1]
+        night_end, night_start = daylight(self.city.observer, today, tzinfo=self.tz)
         night_end += timedelta(days=1)
+        self._night_cache = (today, (night_start, night_end))
         return night_start, night_end
 
 
-    def is_night(self, time: datetime = None):
-        """Check it time is in night"""
-        if time is None: time = datetime.now()
-        night_start, night_end = self.night()
-        _LOGGER.debug('Night start: %s', night_start.isoformat())
-        _LOGGER.debug('Night end  : %s', night_end.isoformat())
-        return (self.stop_at_night and
-                night_start < time.astimezone(self.city.tzinfo) < night_end)
+    def is_night(self, time: datetime):
+        """Check it time is in night, time must be time zone aware (e.g. datetime.now(self.tz))"""
+        if not self.stop_at_night:
+            return False
+        night_start, night_end = self.night(time.date())
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug('Night start: %s', night_start.isoformat())
+            _LOGGER.debug('Night end  : %s', night_end.isoformat())
+        return night_start < time < night_end
+
+
+    def wake_up_time_epoch(self, now: datetime) -> float:
+        """Get wake up time (end of night) as POSIX timestamp, cached for the day of now"""
+        today = now.date()
+        if self._wake_epoch_date != today:
+            self._wake_epoch = self.night(today)[1].timestamp()
+            self._wake_epoch_date = today
+        return self._wake_epoch
 
 
-    def wake_up_time(self):
-        """Get wake up time (end of night)"""
-        _, night_end = self.night()
-        return night_end
+    def sleep_plan(self, now: datetime) -> tuple[bool, float | None]:
+        """Check if now is in night, return it and the wake up time as POSIX timestamp (None at day)"""
+        if self.is_night(now):
+            return True, self.wake_up_time_epoch(now)
+        return False, None
@@ -7,6 +7,7 @@
 import asyncio
 import logging
 import sys
+import time
 
 from argparse import ArgumentParser
 from datetime import datetime, timedelta
@@ -21,30 +22,52 @@ _logger = logging.getLogger(__name__)
 _loop: asyncio.AbstractEventLoop
 _mqtt: MQTTHandler
 
+# max delay between tries to read the inverter device info at startup (s)
+_MAX_RETRY_DELAY = 60
+
+# log formats, function name is expensive to retrieve, so only use it for debugging
+_FMT_DEBUG = "%(levelname)s:%(name)s.%(funcName)s(): %(message)s"
+_FMT_INFO = "%(levelname)s:%(name)s: %(message)s"
+# thread and process info is not logged, do not collect it for every log record
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+
+# command line argument parser
+_PARSER = ArgumentParser(prog="APsystemsEZ1mqtt",
+                         description="Read data from APsystems EZ1 local API and send to MQTT "
+                                     "broker, configure HomA and Home Assistant environment.")
+_PARSER.add_argument("-c", "--config", dest="config_path", help="load YAML config file", metavar="FILE")
+_PARSER.add_argument("-d", "--debug", dest="debug", help="enable debug logs", action="store_true")
+_PARSER.add_argument("-r", "--remove", dest="remove", help="remove retained MQTT topics", action="store_true")
+
 
 def cli_args():
     """Get command line arguments and parse them"""
-    parser = ArgumentParser(prog="APsystemsEZ1mqtt",
-                            description="Read data from APsystems EZ1 local API and send to MQTT "
-                                        "broker, configure HomA and Home Assistant environment.")
-    parser.add_argument("-c", "--config", dest="config_path", help="load YAML config file", metavar="FILE")
-    parser.add_argument("-d", "--debug", dest="debug", help="enable debug logs", action="store_true")
-    parser.add_argument("-r", "--remove", dest="remove", help="remove retained MQTT topics", action="store_true")
-    return parser.parse_args()
+    return _PARSER.parse_args()
+
+
+def use_uvloop():
+    """Install uvloop event loop policy, if uvloop is available (not on Windows)"""
+    try:
+        import uvloop  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 
 async def async_on_status_power(status: bool):
     """Async callback function for MQTTHandler on_status_power"""
     _logger.debug("Start async_on_status_power(status=%r)", status)
     status_power = await _ecu.set_device_power_status(status)
-    _mqtt.publish_status_power(status_power)
+    await _loop.run_in_executor(None, _mqtt.publish_status_power, status_power)
 
 
 async def async_on_max_power(value: int):
     """Async callback function for MQTTHandler on_max_power"""
     _logger.debug("Start async_on_max_power(value=%d)", value)
     max_power = await _ecu.set_max_power(value)
-    _mqtt.publish_max_power(max_power)
+    await _loop.run_in_executor(None, _mqtt.publish_max_power, max_power)
 
 
 async def periodic_wakeup():
@@ -55,46 +78,88 @@ async def periodic_wakeup():
 
 async def periodic_get_data(interval: float):
     """Periodic get output data from ecu"""
+    tz = _ecu.tz
     while True:
-        now = datetime.now()
-        _logger.debug("Start periodic_get_data: %s", now.isoformat())
-        if _ecu.is_night(now):
-            sleeptime = _ecu.wake_up_time().timestamp() - now.timestamp()
+        t0 = time.monotonic()
+        now = datetime.now(tz)
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug("Start periodic_get_data: %s", now.isoformat())
+        is_night, wake_epoch = _ecu.sleep_plan(now)
+        # no data is published at night, tell the subscribers once
+        _mqtt.notify_night(is_night)
+        if is_night:
+            sleeptime = wake_epoch - now.timestamp()
         else:
             sleeptime = interval
             try:
                 ecu_data = await _ecu.get_output_data()
-                _mqtt.publish_data(ecu_data)
+                # publishing may wait for the MQTT broker connection, do not block the event loop meanwhile
+                await _loop.run_in_executor(None, _mqtt.publish_data, ecu_data)
             except (Exception) as e:
                 _logger.error("An exception occured: %s -> %s", e.__class__.__name__, str(e))
 
-        next_update_time = (now.astimezone(_ecu.city.tzinfo) + timedelta(0, sleeptime)).strftime("%Y-%m-%d %H:%M:%S %Z")
         # compensate code runtime
-        sleeptime = max(0, sleeptime - (datetime.now().timestamp() - now.timestamp()))
-        _logger.debug("Next update at: %s (in %0.2fs)", next_update_time, sleeptime)
-        await asyncio.sleep(sleeptime)
+        delay = max(0.0, sleeptime - (time.monotonic() - t0))
+        if _logger.isEnabledFor(logging.DEBUG):
+            next_update_time = (now + timedelta(0, sleeptime)).strftime("%Y-%m-%d %H:%M:%S %Z")
+            _logger.debug("Next update at: %s (in %0.2fs)", next_update_time, delay)
+        await asyncio.sleep(delay)
 
 
 async def periodic_get_power(interval: float):
     """Periodic get power status from ecu"""
+    tz = _ecu.tz
     while True:
-        now = datetime.now()
-        _logger.debug("Start periodic_get_power: %s", now.isoformat())
-        if _ecu.is_night(now):
-            sleeptime = _ecu.wake_up_time().timestamp() - now.timestamp() + interval
+        t0 = time.monotonic()
+        now = datetime.now(tz)
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug("Start periodic_get_power: %s", now.isoformat())
+        is_night, wake_epoch = _ecu.sleep_plan(now)
+        if is_night:
+            sleeptime = wake_epoch - now.timestamp() + interval
         else:
             sleeptime = interval
-            try:
-                max_power = await _ecu.get_max_power()
-                _mqtt.publish_max_power(max_power)
-                status_power = await _ecu.get_device_power_status()
-                _mqtt.publish_status_power(status_power)
-            except (Exception) as e:
-                _logger.error("An exception occured: %s -> %s", e.__class__.__name__, str(e))
+            # query both at once, a failing one does not keep the other from being published
+            results = await asyncio.gather(_ecu.get_max_power(), _ecu.get_device_power_status(),
+                                           return_exceptions=True)
+            for publish, result in zip((_mqtt.publish_max_power, _mqtt.publish_status_power), results):
+                if isinstance(result, Exception):
+                    _logger.error("An exception occured: %s -> %s", result.__class__.__name__, str(result))
+                    continue
+                if isinstance(result, BaseException):
+                    raise result # e.g. asyncio.CancelledError
+                try:
+                    await _loop.run_in_executor(None, publish, result)
+                except (Exception) as e:
+                    _logger.error("An exception occured: %s -> %s", e.__class__.__name__, str(e))
 
-        next_update_time = (now.astimezone(_ecu.city.tzinfo) + timedelta(0, sleeptime)).strftime("%Y-%m-%d %H:%M:%S %Z")
-        _logger.debug("Next update at: %s (in %0.2fs)", next_update_time, sleeptime)
-        await asyncio.sleep(sleeptime)
+        # compensate code runtime
+        delay = max(0.0, sleeptime - (time.monotonic() - t0))
+        if _logger.isEnabledFor(logging.DEBUG):
+            next_update_time = (now + timedelta(0, sleeptime)).strftime("%Y-%m-%d %H:%M:%S %Z")
+            _logger.debug("Next update at: %s (in %0.2fs)", next_update_time, delay)
+        await asyncio.sleep(delay)
+
+
+async def get_device_info(debug: bool) -> ReturnDeviceInfo:
+    """Read the device info from the ECU, retry until it is available (use dummy data if debug)"""
+    retry_delay = 2 # seconds, doubled on every failed try up to _MAX_RETRY_DELAY
+    while True:
+        try:
+            return await _ecu.get_device_info()
+        except Exception:
+            if debug:
+                _logger.info("Can't read APsystems info data. Setting dummy data.")
+                return ReturnDeviceInfo(
+                    deviceId='123456789',
+                    devVer='debug dummy Ver',
+                    ssid='debug dummy ssid',
+                    ipAddr='192.168.9.9',
+                    minPower=int(30),
+                    maxPower=int(800))
+            _logger.error("Can't read APsystems info data. Waiting for %d seconds ...", retry_delay)
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, _MAX_RETRY_DELAY)
 
 
 async def main():
@@ -102,63 +167,59 @@ async def main():
     global _ecu, _mqtt, _loop  # pylint: disable=global-statement
 
     _loop = asyncio.get_event_loop()
+    if hasattr(asyncio, "eager_task_factory"):
+        # Python >= 3.12: tasks that complete without blocking skip a loop iteration
+        _loop.set_task_factory(asyncio.eager_task_factory)
     args = cli_args()
     conf = Config(args.config_path)
     if not conf.ecu_config.ipaddr:
         _logger.error("APS_ECU_IP not found. No config given? Use -h")
         sys.exit(1)
+    if not args.debug:
+        # do not walk the stack to find the caller of each log record
+        logging._srcfile = None  # pylint: disable=protected-access
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
-                        format="%(levelname)s:%(name)s.%(funcName)s(): %(message)s")
+                        format=_FMT_DEBUG if args.debug else _FMT_INFO)
     _ecu = ECU(conf.ecu_config)
-
-    _logger.info("Read data from APsystems EZ1 at http://%s:%d", conf.ecu_config.ipaddr, conf.ecu_config.port)
-    ecu_info = None
-    while ecu_info is None:
+    try:
+        _logger.info("Read data from APsystems EZ1 at http://%s:%d", conf.ecu_config.ipaddr, conf.ecu_config.port)
+        ecu_info = await get_device_info(args.debug)
+
+        if not conf.mqtt_config.homa_systemid:
+            # if no homa_systemid is given in config use deviceId
+            conf.mqtt_config.homa_systemid = ecu_info.deviceId
+        if not conf.mqtt_config.hass_device_id:
+            # if no hass_device_id is given in config use deviceId
+            conf.mqtt_config.hass_device_id = ecu_info.deviceId
+        _mqtt = MQTTHandler(lambda status: _loop.call_soon_threadsafe(asyncio.create_task, async_on_status_power(status)),
+                            lambda value: _loop.call_soon_threadsafe(asyncio.create_task, async_on_max_power(value)),
+                            conf.mqtt_config, retain = not args.debug)
+        _mqtt.connect_mqtt()
         try:
-            ecu_info = await _ecu.get_device_info()
-        except Exception:
-            if args.debug:
-                _logger.info("Can't read APsystems info data. Setting dummy data.")
-                ecu_info = ReturnDeviceInfo(
-                    deviceId='123456789',
-                    devVer='debug dummy Ver',
-                    ssid='debug dummy ssid',
-                    ipAddr='192.168.9.9',
-                    minPower=int(30),
-                    maxPower=int(800))
-            else:
-                _logger.error("Can't read APsystems info data. Waiting for a minute ...")
-                await asyncio.sleep(60)
-
-    if not conf.mqtt_config.homa_systemid:
-        # if no homa_systemid is given in config use deviceId
-        conf.mqtt_config.homa_systemid = ecu_info.deviceId
-    if not conf.mqtt_config.hass_device_id:
-        # if no hass_device_id is given in config use deviceId
-        conf.mqtt_config.hass_device_id = ecu_info.deviceId
-    _mqtt = MQTTHandler(lambda status: _loop.call_soon_threadsafe(asyncio.create_task, async_on_status_power(status)),
-                        lambda value: _loop.call_soon_threadsafe(asyncio.create_task, async_on_max_power(value)),
-                        conf.mqtt_config, retain = not args.debug)
-    _mqtt.connect_mqtt()
-
-    # if -r is passed remove all retained topics and exit
-    if args.remove:
-        _mqtt.clear_all_topics()
-        sys.exit(0)
-
-    _mqtt.hass_init(conf.ecu_config, ecu_info) # must init before homa_init
-    _mqtt.homa_init(ecu_info, _ecu.city.tzinfo)
-
-    _logger.info("Started all periodic tasks. Press <Ctrl>-C to terminate.")
-    await asyncio.gather(
-        periodic_wakeup(),
-        periodic_get_data(conf.ecu_config.update_interval),
-        periodic_get_power(600), # 10min update interval
-    )
+            # if -r is passed remove all retained topics and exit
+            if args.remove:
+                _mqtt.clear_all_topics()
+                sys.exit(0)
+
+            _mqtt.hass_init(conf.ecu_config, ecu_info) # must init before homa_init
+            _mqtt.homa_init(ecu_info, _ecu.tz)
+
+            _logger.info("Started all periodic tasks. Press <Ctrl>-C to terminate.")
+            await asyncio.gather(
+                periodic_wakeup(),
+                periodic_get_data(conf.ecu_config.update_interval),
+                periodic_get_power(600), # 10min update interval
+            )
+        finally:
+            _mqtt.close()
+    finally:
+        # close the HTTP session of the ECU, also if interrupted while reading the device info
+        await _ecu.close()
     _logger.info("main() ended.")
 
 
 if __name__ == "__main__":
     # This is the entry point of the script and it runs the main function in an asynchronous manner (coroutine).
+    use_uvloop()
     asyncio.run(main())
     _logger.info("run(main()) terminated!")
@@ -1,51 +1,192 @@
 # Author: Holger Mueller <github euhm.de>
 # Based on aps2mqtt by Florian L., https://github.com/fligneul/aps2mqtt
 
+# pylint: disable=too-many-instance-attributes
+
 """Handle MQTT connection and data publishing"""
+from collections.abc import Callable
+from dataclasses import dataclass, field
 from datetime import datetime
+import functools
 import json
 import logging
+import socket
+import ssl
+import threading
 import time
+from typing import NamedTuple
 
-import atexit
-import certifi
 from paho.mqtt import client as mqtt_client
 from paho.mqtt.enums import CallbackAPIVersion
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from paho.mqtt.reasoncodes import ReasonCode
 from APsystemsEZ1 import ReturnDeviceInfo, ReturnOutputData
 from apsystems_ez1_mqtt.config import ECUConfig, MQTTConfig
+try:
+    from orjson import dumps as _json_dumps
+except ImportError:
+    # compact and UTF-8 like orjson, the encoder is created once and reused
+    _json_encode = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+
+    def _json_dumps(obj) -> bytes:
+        """Serialize obj to JSON bytes (fallback if orjson is not installed)"""
+        return _json_encode(obj).encode()
 
 _LOGGER = logging.getLogger(__name__)
 
-# amount of max retries to connect to the MQTT broker
-_MAX_RETRY = 10
-
-# dictionary of MQTT messages and HomA / Home Assistant configuration
-# 'topic' is the last part of the topic that is send
-# 'type', 'room' and 'unit' is needed by HomA
-# 'unit', 'comp' (component part of the discovery topic, do not send topic if None) and
-# 'class' (device_class, do not set if None) is needed by Home Assistant
-_mqtt_d = {
-    'pt': {'topic': 'Power',              'type': 'text',   'room': 'Home', 'unit': ' W',   'comp': 'sensor', 'class': 'power'},
-    'p1': {'topic': 'Power P1',           'type': 'text',   'room': '',     'unit': ' W',   'comp': 'sensor', 'class': 'power'},
-    'p2': {'topic': 'Power P2',           'type': 'text',   'room': '',     'unit': ' W',   'comp': 'sensor', 'class': 'power'},
-    'et': {'topic': 'Energy today',       'type': 'text',   'room': 'Home', 'unit': ' kWh', 'comp': 'sensor', 'class': 'energy'},
-    'e1': {'topic': 'Energy today P1',    'type': 'text',   'room': '',     'unit': ' kWh', 'comp': 'sensor', 'class': 'energy'},
-    'e2': {'topic': 'Energy today P2',    'type': 'text',   'room': '',     'unit': ' kWh', 'comp': 'sensor', 'class': 'energy'},
-    'lt': {'topic': 'Energy lifetime',    'type': 'text',   'room': '',     'unit': ' kWh', 'comp': 'sensor', 'class': '_energy_increasing'},
-    'l1': {'topic': 'Energy lifetime P1', 'type': 'text',   'room': '',     'unit': ' kWh', 'comp': 'sensor', 'class': '_energy_increasing'},
-    'l2': {'topic': 'Energy lifetime P2', 'type': 'text',   'room': '',     'unit': ' kWh', 'comp': 'sensor', 'class': '_energy_increasing'},
-    'ps': {'topic': 'Power Status',       'type': 'switch', 'room': '',     'unit': '',     'comp': 'switch', 'class': None},
-    'po': {'topic': 'Power Max Output',   'type': 'text',   'room': '',     'unit': ' W',   'comp': 'number', 'class': 'power', 'min': 30, 'max': 800},
-    'id': {'topic': 'Device id',          'type': 'text',   'room': '',     'unit': '',     'comp': None,     'class': None},
-    'ip': {'topic': 'Device IP',          'type': 'text',   'room': '',     'unit': '',     'comp': None,     'class': None},
-    've': {'topic': 'Version',            'type': 'text',   'room': '',     'unit': '',     'comp': None,     'class': None},
-    'ti': {'topic': 'Start time',         'type': 'text',   'room': '',     'unit': '',     'comp': 'sensor', 'class': '_datetime'},
-    'wi': {'topic': 'State',              'type': 'text',   'room': '',     'unit': '',     'comp': None,     'class': None}, # last will topic
-}
+# max time to wait for the connection to the MQTT broker (s)
+_CONNECT_TIMEOUT = 50
+# max time between messages to the broker (s), a broken connection is detected after 1.5 times of it
+_KEEPALIVE = 30
+# interval to publish all ECU data values, even if unchanged, e.g. for subscribers not using retained messages (s)
+_RESEND_ALL_INTERVAL = 3600
+# min and max delay between reconnection tries (s)
+_RECONNECT_DELAY = (1, 30)
+# formats of the ECU data values: power (W), energy today (kWh), energy lifetime (kWh)
+_FMT_POWER = "%d"
+_FMT_ENERGY = "%0.3f"
+_FMT_LIFETIME = "%0.2f"
+# accepted (lowercase) payloads of the power status switch command
+_STATUS_MAP = {b"0": False, b"off": False, b"false": False, b"1": True, b"on": True, b"true": True}
+# MQTT protocol versions of MQTTConfig.protocol
+_PROTOCOLS = {"3.1.1": mqtt_client.MQTTv311, "5": mqtt_client.MQTTv5}
+# MQTT 5 session expiry interval if a client id is given (s), keeps the session like clean_session=False of MQTT 3
+_SESSION_EXPIRY = 0xFFFFFFFF
+
+
+@functools.cache
+def _default_ca() -> str:
+    """Get the path of the default CA bundle (certifi), certifi is only imported if needed"""
+    import certifi  # pylint: disable=import-outside-toplevel
+    return certifi.where()
+
+
+@functools.cache
+def _ssl_context(ca_certs: str) -> ssl.SSLContext:
+    """Get the TLS context verifying the broker by the CA certificates file ca_certs, it is only loaded once"""
+    return ssl.create_default_context(cafile=ca_certs)
+
+
+@dataclass(slots=True, frozen=True)
+class _Ctl:
+    """
+    MQTT message (control) and its HomA / Home Assistant configuration
+
+    'topic' is the last part of the topic that is send
+    'type', 'room' and 'unit' is needed by HomA
+    'unit', 'comp' (component part of the discovery topic, do not send topic if None),
+    'cls' (device_class, do not set if None), 'min' and 'max' is needed by Home Assistant
+    """
+    key: str
+    topic: str
+    type: str
+    room: str
+    unit: str
+    comp: str | None
+    cls: str | None
+    min: int | None = None
+    max: int | None = None
+    # Home Assistant object id suffix of the control
+    object_id: str = field(init=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "object_id", self.topic.replace(" ", "-"))
+
+
+# all controls, in HomA order
+_CTLS = (
+    _Ctl('pt', 'Power',              'text',   'Home', ' W',   'sensor', 'power'),
+    _Ctl('p1', 'Power P1',           'text',   '',     ' W',   'sensor', 'power'),
+    _Ctl('p2', 'Power P2',           'text',   '',     ' W',   'sensor', 'power'),
+    _Ctl('et', 'Energy today',       'text',   'Home', ' kWh', 'sensor', 'energy'),
+    _Ctl('e1', 'Energy today P1',    'text',   '',     ' kWh', 'sensor', 'energy'),
+    _Ctl('e2', 'Energy today P2',    'text',   '',     ' kWh', 'sensor', 'energy'),
+    _Ctl('lt', 'Energy lifetime',    'text',   '',     ' kWh', 'sensor', '_energy_increasing'),
+    _Ctl('l1', 'Energy lifetime P1', 'text',   '',     ' kWh', 'sensor', '_energy_increasing'),
+    _Ctl('l2', 'Energy lifetime P2', 'text',   '',     ' kWh', 'sensor', '_energy_increasing'),
+    _Ctl('ps', 'Power Status',       'switch', '',     '',     'switch', None),
+    _Ctl('po', 'Power Max Output',   'text',   '',     ' W',   'number', 'power', min=30, max=800),
+    _Ctl('id', 'Device id',          'text',   '',     '',     None,     None),
+    _Ctl('ip', 'Device IP',          'text',   '',     '',     None,     None),
+    _Ctl('ve', 'Version',            'text',   '',     '',     None,     None),
+    _Ctl('ti', 'Start time',         'text',   '',     '',     'sensor', '_datetime'),
+    _Ctl('wi', 'State',              'text',   '',     '',     None,     None), # last will topic
+)
+
+
+class _HassMeta(NamedTuple):
+    """Home Assistant discovery topic, state topic and object id of a control"""
+    ctl: _Ctl
+    topic: str
+    state_topic: str
+    object_id: str
+
+
+class _SharedClient:
+    """MQTT client shared by handlers with the same broker connection, dispatches client callbacks to them"""
+
+    __slots__ = ("client", "handlers", "aliases", "alias_max", "alias_lock")
+
+    def __init__(self, client: mqtt_client.Client):
+        self.client = client
+        self.handlers: list["MQTTHandler"] = []
+        # MQTT 5 topic aliases of the current connection (topic -> PUBLISH properties with the alias)
+        self.aliases: dict[str, Properties] = {}
+        self.alias_max = 0
+        # serialises the alias reset on (re)connect against a batch of publishes using them
+        self.alias_lock = threading.Lock()
+        client.on_connect = self.on_connect
+        client.on_disconnect = self.on_disconnect
+        client.on_publish = self.on_publish
+        client.on_subscribe = self.on_subscribe
+        client.on_socket_open = self.on_socket_open
+
+
+    @staticmethod
+    def on_socket_open(client, userdata, sock):
+        """Send the small MQTT packets without waiting for more data (disable Nagle's algorithm)"""
+        del client, userdata
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        """Start with new topic aliases (as many as the broker allows), then call the handlers"""
+        with self.alias_lock:
+            self.aliases = {}
+            self.alias_max = getattr(properties, "TopicAliasMaximum", 0) if not reason_code.is_failure else 0
+        for handler in self.handlers:
+            handler.on_connect(client, userdata, flags, reason_code, properties)
+
+
+    def on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
+        """Topic aliases are only valid for one connection, drop them and call the handlers"""
+        with self.alias_lock:
+            self.aliases = {}
+            self.alias_max = 0
+        for handler in self.handlers:
+            handler.on_disconnect(client, userdata, disconnect_flags, reason_code, properties)
+
+
+    def on_publish(self, client, userdata, mid, reason_code, properties):
+        """Call the handlers"""
+        for handler in self.handlers:
+            handler.on_publish(client, userdata, mid, reason_code, properties)
+
+
+    def on_subscribe(self, client, userdata, mid, reason_code_list, properties):
+        """Call the handlers"""
+        for handler in self.handlers:
+            handler.on_subscribe(client, userdata, mid, reason_code_list, properties)
+
 
 class MQTTHandler:
     """Handle MQTT connection to broker and publish message"""
 
+    # MQTT clients shared by handlers with the same broker connection
+    _client_pool: dict[tuple, _SharedClient] = {}
+    _client_pool_lock = threading.Lock()
+
     def __init__(self, trigger_on_status_power, trigger_async_on_max_power, mqtt_config: MQTTConfig, *, qos: int = 1, retain = False):
         self.mqtt_config = mqtt_config
         self.qos = qos
@@ -53,33 +194,115 @@ class MQTTHandler:
         self.trigger_async_on_status_power = trigger_on_status_power
         self.trigger_async_on_max_power = trigger_async_on_max_power
         self.client = None
-
-
-    def on_connect(self, client, userdata, flags, rc):
+        self._shared: _SharedClient | None = None
+        self._client_publish = None
+        self._connected_evt = threading.Event()
+        # serialized Home Assistant discovery messages (topic, payload, qos) and the device data they were built from
+        self._hass_msgs: list[tuple[str, bytes, int]] = []
+        self._hass_msgs_key: tuple | None = None
+        # discovery messages retained by the broker (topic -> payload), received on subscribe, and the
+        # subscription (message id of the last SUBSCRIBE) they are complete on
+        self._hass_retained: dict[str, bytes] = {}
+        self._subscribe_lock = threading.Lock()
+        self._subscribe_mid: int | None = None
+        self._subscribed_evt = threading.Event()
+        # last published ECU data messages (topic -> value), cleared on (re)connect and
+        # every _RESEND_ALL_INTERVAL (monotonic time of next one) to send all of them again
+        self._last_values: dict[str, str] = {}
+        self._resend_all_at = 0.0
+        # start time of the application, set on first HomA init
+        self._start_ts_iso: str | None = None
+        # ECU is sleeping (night), the HomA state is "sleeping" instead of "online"
+        self.asleep = False
+        # HomA state is published by homa_init and removed by clear_all_topics, set it "offline" on close only if published
+        self._state_published = False
+
+        # topics depend on config only, so build them once
+        topic_base = self._get_topic_base()
+        self._topics = {ctl.key: topic_base + ctl.topic for ctl in _CTLS}
+        # command topics of power status switch and max power
+        self._ps_on = self._topics['ps'] + "/on"
+        self._po_on = self._topics['po'] + "/on"
+        # HomA meta topics and messages of all controls
+        self._homa_meta = []
+        for order, ctl in enumerate(_CTLS, 1):
+            topic = topic_base + ctl.topic
+            self._homa_meta += [(topic + "/meta/type", ctl.type),
+                                (topic + "/meta/order", order),
+                                (topic + "/meta/room", ctl.room),
+                                (topic + "/meta/unit", ctl.unit)]
+        # HomA meta topics and messages of the device
+        meta_base = topic_base.replace("/controls/", "/meta/")
+        self._homa_device_meta = [(meta_base + "name", mqtt_config.homa_name),
+                                  (meta_base + "room", mqtt_config.homa_room)]
+        # Home Assistant discovery meta of all controls with a component
+        self._hass_meta: list[_HassMeta] = []
+        for ctl in _CTLS:
+            if ctl.comp is None:
+                continue
+            object_id = mqtt_config.hass_device_id + "-" + ctl.object_id
+            # topic: <discovery_prefix>/<component>/[<node_id>/]<object_id>/config
+            self._hass_meta.append(_HassMeta(ctl, "/".join(["homeassistant", ctl.comp, object_id, "config"]),
+                                             self._topics[ctl.key], object_id))
+        # Home Assistant discovery topics and payload templates, the device is filled in by hass_init
+        self._hass_templates = [self._hass_config(hass_meta) for hass_meta in self._hass_meta]
+        # empty retained messages of all topics, an empty retained message deletes the retained one
+        # on the broker, there is no need to confirm it (qos 0)
+        self._clear_msgs = [(topic, None, 0) for topic in self._get_clear_topics()]
+
+
+    def on_connect(self, client, userdata, flags, reason_code: ReasonCode, properties: Properties | None):
         """Callback function on broker connection"""
-        del userdata, flags
+        del userdata, flags, properties
 
-        # Subscribe to topics with specific callbacks
-        topic_base = self._get_topic_base()
-        client.subscribe(topic_base + _mqtt_d['ps']['topic'] + "/on")
-        client.subscribe(topic_base + _mqtt_d['po']['topic'] + "/on")
-        if rc == 0:
+        if not reason_code.is_failure:
+            self._subscribe(client)
+            self._last_values.clear()
+            self._connected_evt.set()
             _LOGGER.info("Successfully connected to MQTT Broker.")
         else:
-            _LOGGER.error("Failed to connect: %s", mqtt_client.connack_string(rc))
+            _LOGGER.error("Failed to connect: %s", reason_code)
 
 
-    def on_disconnect(self, client, userdata, rc):
+    def _subscribe(self, client: mqtt_client.Client):
+        """Subscribe to topics with specific callbacks"""
+        # the lock keeps on_subscribe from checking the message id before it is set
+        with self._subscribe_lock:
+            self._subscribed_evt.clear()
+            if self.mqtt_config.hass_enabled:
+                # the broker sends the retained discovery messages before it handles the next SUBSCRIBE,
+                # so they are received when the last SUBSCRIBE is acknowledged
+                self._hass_retained.clear()
+                client.subscribe([(hass_meta.topic, 0) for hass_meta in self._hass_meta])
+            client.subscribe(self._ps_on)
+            _, self._subscribe_mid = client.subscribe(self._po_on)
+
+
+    def on_subscribe(self, client, userdata, mid: int, reason_code_list: list[ReasonCode], properties: Properties | None):
+        """Callback function on subscription acknowledged by the broker"""
+        del client, userdata, reason_code_list, properties
+        with self._subscribe_lock:
+            if mid == self._subscribe_mid:
+                self._subscribed_evt.set()
+
+
+    def on_disconnect(self, client, userdata, disconnect_flags, reason_code: ReasonCode, properties: Properties | None):
         """Callback function on broker disconnection"""
-        del client, userdata
-        _LOGGER.info("Disconnected from MQTT Broker: %s", mqtt_client.error_string(rc))
+        del client, userdata, disconnect_flags, properties
+        self._connected_evt.clear()
+        if not reason_code.is_failure:
+            _LOGGER.info("Disconnected from MQTT Broker: %s", reason_code)
+        else:
+            # the network thread of paho reconnects on its own, using the reconnect delay
+            _LOGGER.warning("Lost connection to MQTT Broker: %s. Reconnecting in %d to %d s.",
+                            reason_code, *_RECONNECT_DELAY)
 
 
     def on_status_power(self, client, userdata, message: mqtt_client.MQTTMessage):  # pylint: disable=unused-argument
         """Callback function on power status change (switch on or off)"""
-        _LOGGER.debug("Received `%s` on topic `%s` (qos=%d, retain=%r)", message.payload.decode(), message.topic, message.qos, message.retain)
-        status_map = {"0": False, "off": False, "false": False, "1": True, "on": True, "true": True}
-        status = status_map.get(message.payload.decode().lower())
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("Received `%s` on topic `%s` (qos=%d, retain=%r)", message.payload.decode(), message.topic, message.qos, message.retain)
+        status = _STATUS_MAP.get(message.payload.lower())
         if status is None:
             raise ValueError(
                 f"Invalid power status: expected '0', 'ON' or '1', 'OFF', got '{message.payload.decode()}'")
@@ -87,20 +310,75 @@ class MQTTHandler:
         self.trigger_async_on_status_power(status)
 
 
+    def on_hass_config(self, client, userdata, message: mqtt_client.MQTTMessage):  # pylint: disable=unused-argument
+        """Callback function on Home Assistant discovery message, keep the ones retained by the broker"""
+        if message.retain:
+            self._hass_retained[message.topic] = message.payload
+
+
     def on_max_power(self, client, userdata, message: mqtt_client.MQTTMessage):  # pylint: disable=unused-argument
         """Callback function on max power change"""
-        _LOGGER.debug("Received `%s` on topic `%s` (qos=%d, retain=%r)", message.payload.decode(), message.topic, message.qos, message.retain)
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("Received `%s` on topic `%s` (qos=%d, retain=%r)", message.payload.decode(), message.topic, message.qos, message.retain)
         # create a task in the main event loop
         self.trigger_async_on_max_power(int(message.payload.decode()))
 
 
-    def _publish(self, client, topic: str, msg: mqtt_client.PayloadType, qos: int = 0, retain: bool = False):  # pylint: disable=too-many-positional-arguments
-        result = client.publish(topic, msg, qos, retain)
-        status = result[0]
-        if status == 0:
-            _LOGGER.debug("Send `%s` to topic `%s` (qos=%d, retain=%r)", msg, topic, qos, retain)
+    def _publish_many(self, msgs: list[tuple[str, mqtt_client.PayloadType, int]]) -> mqtt_client.MQTTMessageInfo | None:
+        """
+        Publish (topic, msg, qos) tuples back to back.
+
+        The alias lock of the shared client is held for all of them, so the topic aliases are not reset
+        by a reconnect in the middle of the batch.
+        Return codes are not checked, delivery is reported by on_publish.
+        Using MQTT 5, qos 0 messages are sent with a topic alias, so repeated topics are sent as a number
+        only. qos > 0 messages do not get an alias, as they may be resent on a new connection.
+        Returns the message info of the last message, None if msgs is empty.
+        """
+        debug = _LOGGER.isEnabledFor(logging.DEBUG)
+        client_publish = self._client_publish
+        shared = self._shared
+        info = None
+        with shared.alias_lock:
+            # aliases are reset by the network thread on (re)connect, which needs the alias lock
+            aliases = shared.aliases
+            alias_max = shared.alias_max
+            for topic, msg, qos in msgs:
+                if qos or not alias_max:
+                    info = client_publish(topic, msg, qos=qos)
+                elif (properties := aliases.get(topic)) is not None:
+                    # alias is known by the broker, no need to send the topic
+                    info = client_publish("", msg, qos=qos, properties=properties)
+                elif len(aliases) < alias_max:
+                    properties = Properties(PacketTypes.PUBLISH)
+                    properties.TopicAlias = len(aliases) + 1
+                    aliases[topic] = properties
+                    info = client_publish(topic, msg, qos=qos, properties=properties)
+                else:
+                    info = client_publish(topic, msg, qos=qos)
+                if debug:
+                    _LOGGER.debug("Send `%s` to topic `%s` (qos=%d, retain=%r)", msg, topic, qos, self.retain)
+        return info
+
+
+    @staticmethod
+    def _wait_for_publish(info: mqtt_client.MQTTMessageInfo | None):
+        """Wait until the message of info is published, so are the messages queued before it"""
+        if info is None or info.rc != mqtt_client.MQTT_ERR_SUCCESS:
+            return
+        info.wait_for_publish(_CONNECT_TIMEOUT)
+        if not info.is_published():
+            _LOGGER.warning("Not all MQTT messages are published within %d s", _CONNECT_TIMEOUT)
+
+
+    def on_publish(self, client, userdata, mid: int, reason_code: ReasonCode, properties: Properties | None):
+        """Callback function on message sent to the broker (acknowledged for qos > 0)"""
+        del client, userdata, properties
+        if reason_code.is_failure:
+            # MQTT 5 brokers may refuse a message, e.g. if the user is not authorized for the topic
+            _LOGGER.error("Failed to publish message %d: %s", mid, reason_code)
         else:
-            _LOGGER.error("Failed to send message to topic %s: %s", topic, mqtt_client.error_string(status))
+            _LOGGER.debug("Message %d published", mid)
 
 
     def _get_topic_base(self) -> str:
@@ -116,11 +394,122 @@ class MQTTHandler:
         return topic_base
 
 
+    def _get_clear_topics(self) -> list[str]:
+        """Get all HomA, "normal" and Home Assistant config topics, that may have been published"""
+        # do not use self._get_topic_base() here, as we really want to remove the HomA and "normal" topics
+        homa_base = "/devices/" + self.mqtt_config.homa_systemid + "/" # e.g. "/devices/123456-solar/"
+        topic_base = self.mqtt_config.topic_prefix # e.g. "aps/"
+
+        topics = [homa_base + "meta/name", homa_base + "meta/room"]
+        homa_base += "controls/" # e.g. "/devices/123456-solar/controls/"
+        for topic in (ctl.topic for ctl in _CTLS):
+            topics += [topic_base + topic,
+                       homa_base + topic,
+                       homa_base + topic + "/meta/type",
+                       homa_base + topic + "/meta/order",
+                       homa_base + topic + "/meta/room",
+                       homa_base + topic + "/meta/unit"]
+        # Home Assistant config topics
+        topics += [hass_meta.topic for hass_meta in self._hass_meta]
+        return topics
+
+
+    @classmethod
+    def _get_or_create_client(cls, handler: "MQTTHandler") -> tuple[_SharedClient, bool]:
+        """
+        Get the MQTT client for the broker connection of handler and register handler as its user.
+
+        Handlers using the same broker, client id and user share one client (connection and network thread).
+        Returns the shared client and True, if it was created and needs to be set up and connected.
+        """
+        cfg = handler.mqtt_config
+        key = (cfg.broker_addr, cfg.broker_port, cfg.client_id, cfg.broker_user)
+        with cls._client_pool_lock:
+            if key in cls._client_pool:
+                shared = cls._client_pool[key]
+                shared.handlers.append(handler)
+                return shared, False
+
+            _LOGGER.debug("Create MQTT client (MQTT %s)", cfg.protocol)
+            protocol = _PROTOCOLS[cfg.protocol]
+            # MQTT 5 uses clean_start and the session expiry interval on connect instead of clean_session
+            client = mqtt_client.Client(CallbackAPIVersion.VERSION2, cfg.client_id, protocol=protocol,
+                                        clean_session=None if protocol == mqtt_client.MQTTv5 else not cfg.client_id)
+            shared = _SharedClient(client)
+            shared.handlers.append(handler)
+            cls._client_pool[key] = shared
+            return shared, True
+
+
+    def close(self):
+        """
+        Unregister from the shared MQTT client. If this was the last user, disconnect from the broker
+        and stop the network thread of the client.
+        """
+        cfg = self.mqtt_config
+        key = (cfg.broker_addr, cfg.broker_port, cfg.client_id, cfg.broker_user)
+        with self._client_pool_lock:
+            shared = self._client_pool.get(key)
+            if shared is None or self not in shared.handlers:
+                return
+            shared.handlers.remove(self)
+            # remove the message callbacks of this handler, a topic has one callback only,
+            # so give it back to another handler using the same topic
+            topics = {topic for topic, _ in self._message_callbacks()}
+            for topic in topics:
+                shared.client.message_callback_remove(topic)
+            for handler in shared.handlers:
+                for topic, callback in handler._message_callbacks():  # pylint: disable=protected-access
+                    if topic in topics:
+                        shared.client.message_callback_add(topic, callback)
+            if not shared.handlers:
+                del self._client_pool[key]
+                if self._state_published:
+                    # the broker does not send the last will on a clean disconnect, so send it here
+                    shared.client.publish(self._topics['wi'], "offline", 1, True)
+                else:
+                    # do not create the state topic, e.g. after clear_all_topics
+                    shared.client.will_clear()
+                # the network thread writes all queued messages and the DISCONNECT before it stops
+                shared.client.disconnect()
+                shared.client.loop_stop()
+
+
+    def _message_callbacks(self) -> list[tuple[str, Callable]]:
+        """Get the (topic, callback) of all subscribed topics"""
+        # power status switch and max power commands
+        callbacks = [(self._ps_on, self.on_status_power), (self._po_on, self.on_max_power)]
+        if self.mqtt_config.hass_enabled:
+            callbacks += [(hass_meta.topic, self.on_hass_config) for hass_meta in self._hass_meta]
+        return callbacks
+
+
     def connect_mqtt(self):
         """Create connection to MQTT broker"""
-        _LOGGER.debug("Create MQTT client")
-        self.client = mqtt_client.Client(CallbackAPIVersion.VERSION1, self.mqtt_config.client_id,
-                                         clean_session=not self.mqtt_config.client_id)
+        self._shared, created = self._get_or_create_client(self)
+        self.client = self._shared.client
+        # all messages are published using the same qos and retain flag, the return code is not checked
+        # (delivery is reported by on_publish, paho keeps qos > 0 messages while not connected)
+        self._client_publish = functools.partial(self.client.publish, qos=self.qos, retain=self.retain)
+
+        for topic, callback in self._message_callbacks():
+            self.client.message_callback_add(topic, callback)
+
+        if not created:
+            _LOGGER.debug("Use existing MQTT client")
+            if self.client.is_connected():
+                # on_connect of the client was already called, so subscribe now
+                self._subscribe(self.client)
+                self._last_values.clear()
+                self._connected_evt.set()
+            return
+
+        # qos > 0 messages on the way to the broker and waiting for it, the default lets HomA and Home Assistant
+        # init (about 85 messages) go out in one go, waiting for the acknowledgements once at the end.
+        # The queue is bounded, so a long broker outage does not pile up messages
+        self.client.max_inflight_messages_set(self.mqtt_config.max_inflight)
+        self.client.max_queued_messages_set(self.mqtt_config.max_queued)
+        self.client.reconnect_delay_set(*_RECONNECT_DELAY)
 
         if len(self.mqtt_config.broker_user.strip()) > 0:
             _LOGGER.debug("Connect with user '%s'", self.mqtt_config.broker_user)
@@ -132,49 +521,38 @@ class MQTTHandler:
 
         if self.mqtt_config.secured_connection:
             _LOGGER.debug("Use secured connection")
-            if self.mqtt_config.cacerts_path is None:
+            ca_certs = self.mqtt_config.cacerts_path
+            if ca_certs is None:
                 _LOGGER.warning("No ca_certs defined, using default one")
+                ca_certs = _default_ca()
 
-            self.client.tls_set(
-                ca_certs=(
-                    self.mqtt_config.cacerts_path
-                    if self.mqtt_config.cacerts_path is not None
-                    else certifi.where()
-                )
-            )
+            self.client.tls_set_context(_ssl_context(ca_certs))
         else:
             _LOGGER.debug("Use unsecured connection")
 
-        self.client.will_set(_mqtt_d['wi']['topic'], "offline", 1, True)
-        self.client.on_connect = self.on_connect
-        self.client.on_disconnect = self.on_disconnect
-
-        # add callback for power status switch
-        topic_base = self._get_topic_base()
-        topic = topic_base + _mqtt_d['ps']['topic'] + "/on"
-        self.client.message_callback_add(topic, self.on_status_power)
-        topic = topic_base + _mqtt_d['po']['topic'] + "/on"
-        self.client.message_callback_add(topic, self.on_max_power)
+        self.client.will_set(self._topics['wi'], "offline", 1, True)
 
         _LOGGER.info(
             "Connect to broker '%s' on port %s",
             self.mqtt_config.broker_addr,
             self.mqtt_config.broker_port,
         )
-        self.client.connect_async(self.mqtt_config.broker_addr, self.mqtt_config.broker_port)
+        if self.client.protocol == mqtt_client.MQTTv5:
+            properties = None
+            if self.mqtt_config.client_id:
+                properties = Properties(PacketTypes.CONNECT)
+                properties.SessionExpiryInterval = _SESSION_EXPIRY
+            self.client.connect_async(self.mqtt_config.broker_addr, self.mqtt_config.broker_port, _KEEPALIVE,
+                                      clean_start=not self.mqtt_config.client_id, properties=properties)
+        else:
+            self.client.connect_async(self.mqtt_config.broker_addr, self.mqtt_config.broker_port, _KEEPALIVE)
         self.client.loop_start()
-        atexit.register(self.client.loop_stop)
 
 
     def _check_mqtt_connected(self):
-        """Check MQTT broker connection"""
-        retry_count = 0
-        while not self.client.is_connected() and retry_count < _MAX_RETRY:
-            _LOGGER.debug("MQTT client not connected...")
-            retry_count += 1
-            time.sleep(5)
-
-        if retry_count == _MAX_RETRY:
+        """Check MQTT broker connection, wait for it if not connected"""
+        # is_set() does not take the lock of the event, only wait if not connected
+        if not self._connected_evt.is_set() and not self._connected_evt.wait(_CONNECT_TIMEOUT):
             _LOGGER.warning("MQTT values not published")
             raise ConnectionError("Can't connect to broker")
 
@@ -183,50 +561,68 @@ class MQTTHandler:
         """Publish ECU max power data to MQTT"""
         _LOGGER.debug("Start publish_max_power(max_power=%d)", max_power)
         self._check_mqtt_connected()
-        topic_base = self._get_topic_base()
         if max_power is not None:
-            self._publish(self.client, topic_base + _mqtt_d['po']['topic'],
-                          max_power, self.qos, self.retain)
+            self._client_publish(self._topics['po'], max_power)
 
 
     def publish_status_power(self, status: bool | None):
         """Publish ECU power status to MQTT"""
         _LOGGER.debug("Start publish_status_power(status=%r)", status)
         self._check_mqtt_connected()
-        topic_base = self._get_topic_base()
         if status is not None:
-            self._publish(self.client, topic_base + _mqtt_d['ps']['topic'],
-                          "1" if status else "0", self.qos, self.retain)
+            self._client_publish(self._topics['ps'], "1" if status else "0")
+
+
+    def notify_night(self, is_night: bool):
+        """Publish the HomA state "sleeping" when the night starts and "online" when it ends"""
+        if is_night == self.asleep:
+            return
+        self.asleep = is_night
+        _LOGGER.debug("Start notify_night(is_night=%r)", is_night)
+        if self.mqtt_config.homa_enabled:
+            # paho keeps the (qos > 0) message while not connected, so there is no need to wait for the broker
+            self._client_publish(self._topics['wi'], "sleeping" if is_night else "online")
 
 
     def publish_data(self, data):
-        """Publish ECU data to MQTT"""
+        """Publish ECU data to MQTT, unchanged values are skipped"""
         _LOGGER.debug("Start MQTT publish")
         self._check_mqtt_connected()
 
         if data is not None:
-            for topic, value in self._parse_data(data).items():
-                self._publish(self.client, topic, value, self.qos, self.retain)
+            last_values = self._last_values
+            now = time.monotonic()
+            if now >= self._resend_all_at:
+                last_values.clear()
+                self._resend_all_at = now + _RESEND_ALL_INTERVAL
+            # skip unchanged values, the broker retains them
+            msgs = [msg for msg in self._parse_data(data) if last_values.get(msg[0]) != msg[1]]
+            if msgs:
+                self._publish_many(msgs)
+                last_values.update((topic, value) for topic, value, _ in msgs)
             _LOGGER.debug("MQTT values published")
 
 
-    def _parse_data(self, data: ReturnOutputData):
+    def _parse_data(self, data: ReturnOutputData) -> list[tuple[str, str, int]]:
         """
         Parse data from APsystemsEZ1 ReturnOutputData
         The data include power output status ('p1', 'p2'), energy readings ('e1', 'e2'), and total energy ('te1', 'te2')
         """
-        output = {}
-        topic_base = self._get_topic_base()
-        output[topic_base + _mqtt_d['pt']['topic']] = f'{(data.p1 + data.p2):d}'
-        output[topic_base + _mqtt_d['p1']['topic']] = f'{data.p1:d}'
-        output[topic_base + _mqtt_d['p2']['topic']] = f'{data.p2:d}'
-        output[topic_base + _mqtt_d['et']['topic']] = f'{(data.e1 + data.e2):0.3f}'
-        output[topic_base + _mqtt_d['e1']['topic']] = f'{data.e1:0.3f}'
-        output[topic_base + _mqtt_d['e2']['topic']] = f'{data.e2:0.3f}'
-        output[topic_base + _mqtt_d['lt']['topic']] = f'{(data.te1 + data.te2):0.2f}'
-        output[topic_base + _mqtt_d['l1']['topic']] = f'{data.te1:0.2f}'
-        output[topic_base + _mqtt_d['l2']['topic']] = f'{data.te2:0.2f}'
-        return output
+        # power values are superseded by the next poll, so there is no need to confirm them (qos 0)
+        topics = self._topics
+        qos = self.qos
+        p1, p2, e1, e2, te1, te2 = data.p1, data.p2, data.e1, data.e2, data.te1, data.te2
+        return [
+            (topics['pt'], _FMT_POWER % (p1 + p2), 0),
+            (topics['p1'], _FMT_POWER % p1, 0),
+            (topics['p2'], _FMT_POWER % p2, 0),
+            (topics['et'], _FMT_ENERGY % (e1 + e2), qos),
+            (topics['e1'], _FMT_ENERGY % e1, qos),
+            (topics['e2'], _FMT_ENERGY % e2, qos),
+            (topics['lt'], _FMT_LIFETIME % (te1 + te2), qos),
+            (topics['l1'], _FMT_LIFETIME % te1, qos),
+            (topics['l2'], _FMT_LIFETIME % te2, qos),
+        ]
 
 
     def homa_init(self, ecu_info: ReturnDeviceInfo, tz):
@@ -239,25 +635,21 @@ class MQTTHandler:
 
         self._check_mqtt_connected()
 
+        if self._start_ts_iso is None:
+            self._start_ts_iso = datetime.now(tz).isoformat(timespec='seconds')
+
         # setup controls
-        topic_base = self._get_topic_base()
-        order = 1
-        for _, homa in _mqtt_d.items():
-            self._publish(self.client, topic_base + homa['topic'] + "/meta/type", homa['type'], self.qos, self.retain)
-            self._publish(self.client, topic_base + homa['topic'] + "/meta/order", order, self.qos, self.retain)
-            self._publish(self.client, topic_base + homa['topic'] + "/meta/room", homa['room'], self.qos, self.retain)
-            self._publish(self.client, topic_base + homa['topic'] + "/meta/unit", homa['unit'], self.qos, self.retain)
-            order += 1
-
-        self._publish(self.client, topic_base + _mqtt_d['id']['topic'], ecu_info.deviceId, self.qos, self.retain)
-        self._publish(self.client, topic_base + _mqtt_d['ip']['topic'], ecu_info.ipAddr, self.qos, self.retain)
-        self._publish(self.client, topic_base + _mqtt_d['ve']['topic'], ecu_info.devVer, self.qos, self.retain)
-        self._publish(self.client, topic_base + _mqtt_d['ti']['topic'], datetime.now(tz).isoformat(timespec='seconds'), self.qos, self.retain)
-        self._publish(self.client, topic_base + _mqtt_d['wi']['topic'], "online", self.qos, self.retain) # last will as long as connected
-
-        topic_base = topic_base.replace("/controls/", "/meta/")
-        self._publish(self.client, topic_base + "name", self.mqtt_config.homa_name, self.qos, self.retain)
-        self._publish(self.client, topic_base + "room", self.mqtt_config.homa_room, self.qos, self.retain)
+        msgs = self._homa_meta.copy()
+        msgs += [(self._topics['id'], ecu_info.deviceId),
+                 (self._topics['ip'], ecu_info.ipAddr),
+                 (self._topics['ve'], ecu_info.devVer),
+                 (self._topics['ti'], self._start_ts_iso),
+                 (self._topics['wi'], "online")] # last will as long as connected
+        msgs += self._homa_device_meta
+
+        qos = self.qos
+        self._wait_for_publish(self._publish_many([(topic, msg, qos) for topic, msg in msgs]))
+        self._state_published = True
 
         _LOGGER.debug("HomA MQTT values published")
 
@@ -270,29 +662,10 @@ class MQTTHandler:
             _LOGGER.debug("Home Assistant not enabled. Stopping here.")
             return
 
-        self._check_mqtt_connected()
-        for _, item in _mqtt_d.items():
-            self._hass_config(item, ecu_config, ecu_info)
-
-
-    def _hass_config(self, mqtt_d_item, ecu_config: ECUConfig, ecu_info: ReturnDeviceInfo):
-        """Send a single Home Assistant config message to enable discovery"""
-        # pylint: disable=too-many-branches
-        if mqtt_d_item['comp'] is None:
-            return
-
-        object_id = self.mqtt_config.hass_device_id + "-" + str(mqtt_d_item['topic']).replace(" ", "-")
-        state_topic = self._get_topic_base() + mqtt_d_item['topic']
-
-        # topic: <discovery_prefix>/<component>/[<node_id>/]<object_id>/config
-        topic = "/".join(["homeassistant", mqtt_d_item['comp'], object_id, "config"])
-
-        payload = {
-            "name":self.mqtt_config.hass_name_prefix + mqtt_d_item['topic'],
-            "state_topic":state_topic,
-            "unique_id":object_id,
-            "object_id":object_id,
-            "device":{
+        # build the messages first, the network thread of paho may still be connecting meanwhile
+        key = (ecu_info.devVer, ecu_info.deviceId, ecu_config.ipaddr, ecu_config.port)
+        if key != self._hass_msgs_key:
+            device = {
                 "identifiers":[self.mqtt_config.hass_device_id],
                 "name":self.mqtt_config.hass_device_name,
                 "manufacturer":"APsystems",
@@ -302,41 +675,72 @@ class MQTTHandler:
                  #"serial_number":ecu_info.deviceId, # is broken at HA 2023.7.3, if used discover messages do not work
                 "sw_version":ecu_info.devVer
             }
+            # the device is the same for all controls, serialize it once
+            device_json = _json_dumps(device) + b"}"
+            qos = self.qos
+            self._hass_msgs = [(topic, template + device_json, qos) for topic, template in self._hass_templates]
+            self._hass_msgs_key = key
+
+        self._check_mqtt_connected()
+        # skip the messages the broker retains already, unchanged config is the usual case on restart
+        if not self._subscribed_evt.wait(_CONNECT_TIMEOUT):
+            _LOGGER.warning("Retained Home Assistant config not received, sending all of it")
+        retained = self._hass_retained
+        msgs = [msg for msg in self._hass_msgs if retained.get(msg[0]) != msg[1]]
+        _LOGGER.debug("Send %d of %d Home Assistant config messages", len(msgs), len(self._hass_msgs))
+        self._wait_for_publish(self._publish_many(msgs))
+
+
+    def _hass_config(self, hass_meta: _HassMeta) -> tuple[str, bytes]:
+        """
+        Build a single Home Assistant config message (topic, payload template) of a self._hass_meta entry to enable discovery.
+
+        The payload template is the serialized JSON object without the device, it ends with `,"device":`,
+        so the serialized device and the closing `}` have to be appended.
+        """
+        # pylint: disable=too-many-branches
+        ctl, topic, state_topic, object_id = hass_meta
+
+        payload = {
+            "name":self.mqtt_config.hass_name_prefix + ctl.topic,
+            "state_topic":state_topic,
+            "unique_id":object_id,
+            "object_id":object_id
         }
         # add unit, if there is one
-        if mqtt_d_item['unit']:
-            payload['unit_of_measurement'] = str(mqtt_d_item['unit']).strip()
+        if ctl.unit:
+            payload['unit_of_measurement'] = ctl.unit.strip()
 
         # special handling depending on dict['comp']
-        if mqtt_d_item['comp'] == "number":
-            if mqtt_d_item['class']: payload['device_class'] = mqtt_d_item['class']
+        if ctl.comp == "number":
+            if ctl.cls: payload['device_class'] = ctl.cls
             payload['command_topic'] = state_topic + "/on"
             #payload['mode'] = "box"
             #payload['icon'] = "mdi:lightning-bolt-outline"
-            if 'min' in mqtt_d_item and mqtt_d_item['min']: payload['min'] = mqtt_d_item['min']
-            if 'max' in mqtt_d_item and mqtt_d_item['max']: payload['max'] = mqtt_d_item['max']
-        elif mqtt_d_item['comp'] == "switch":
+            if ctl.min: payload['min'] = ctl.min
+            if ctl.max: payload['max'] = ctl.max
+        elif ctl.comp == "switch":
             payload['command_topic'] = state_topic + "/on"
             payload['payload_off'] = "0"
             payload['payload_on'] = "1"
-        elif mqtt_d_item['comp'] == "sensor":
-            if mqtt_d_item['class'] in ["energy", "power"]:
-                payload['device_class'] = mqtt_d_item['class']
+        elif ctl.comp == "sensor":
+            if ctl.cls in ["energy", "power"]:
+                payload['device_class'] = ctl.cls
                 payload['state_class'] = "measurement"
-            elif mqtt_d_item['class'] == "_energy_total":
+            elif ctl.cls == "_energy_total":
                 payload['device_class'] = "energy"
                 payload['state_class'] = "total"
-            elif mqtt_d_item['class'] == "_energy_increasing":
+            elif ctl.cls == "_energy_increasing":
                 payload['device_class'] = "energy"
                 payload['state_class'] = "total_increasing"
-            elif mqtt_d_item['class'] == "_datetime":
+            elif ctl.cls == "_datetime":
                 #payload['device_class'] = "date" # do not set date class, as output cuts time
                 payload['value_template'] = "{{ as_datetime(value) }}"
                 payload['icon'] = "mdi:calendar-arrow-right"
-            elif mqtt_d_item['class']:
-                payload['device_class'] = mqtt_d_item['class']
+            elif ctl.cls:
+                payload['device_class'] = ctl.cls
 
-        self._publish(self.client, topic, json.dumps(payload), self.qos, self.retain)
+        return topic, _json_dumps(payload)[:-1] + b',"device":'
 
 
     def clear_all_topics(self):
@@ -345,26 +749,8 @@ class MQTTHandler:
 
         self._check_mqtt_connected()
 
-        # do not use self._get_topic_base() here, as we really want to remove the HomA and "normal" topics
-        homa_base = "/devices/" + self.mqtt_config.homa_systemid + "/" # e.g. "/devices/123456-solar/"
-        topic_base = self.mqtt_config.topic_prefix # e.g. "aps/"
-
-        self._publish(self.client, homa_base + "meta/name", None, self.qos, self.retain)
-        self._publish(self.client, homa_base + "meta/room", None, self.qos, self.retain)
-
-        homa_base += "controls/" # e.g. "/devices/123456-solar/controls/"
-        for _, item in _mqtt_d.items():
-            self._publish(self.client, topic_base + item['topic'], None, self.qos, self.retain)
-            self._publish(self.client, homa_base + item['topic'], None, self.qos, self.retain)
-            self._publish(self.client, homa_base + item['topic'] + "/meta/type", None, self.qos, self.retain)
-            self._publish(self.client, homa_base + item['topic'] + "/meta/order", None, self.qos, self.retain)
-            self._publish(self.client, homa_base + item['topic'] + "/meta/room", None, self.qos, self.retain)
-            self._publish(self.client, homa_base + item['topic'] + "/meta/unit", None, self.qos, self.retain)
-
-            # clear Home Assistant config topics
-            if item['comp']:
-                object_id = self.mqtt_config.hass_device_id + "-" + str(item['topic']).replace(" ", "-")
-                hass_topic = "/".join(["homeassistant", item['comp'], object_id, "config"])
-                self._publish(self.client, hass_topic, None, self.qos, self.retain)
+        # the application exits after clearing, so wait until all messages are written to the socket
+        self._wait_for_publish(self._publish_many(self._clear_msgs))
+        self._state_published = False
 
         _LOGGER.info("All MQTT topics cleared.")